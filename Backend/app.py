@@ -1,8 +1,7 @@
 # Backend/app.py
 from flask import Flask, request, jsonify
-from werkzeug.utils import secure_filename
 from pathlib import Path
-import os, traceback
+import os, shutil, traceback
 from flask_cors import CORS
 
 # Make project paths
@@ -10,19 +9,44 @@ BASE_DIR = Path(__file__).resolve().parent
 PROJECT_ROOT = BASE_DIR.parent
 DATA_DIR = PROJECT_ROOT / "data"
 FORMS_DIR = DATA_DIR / "forms"
+STORE_DIR = DATA_DIR / "store"  # content-addressed uploads + their derived products
+CODELIST_INDEX_PRODUCT = "codelist_index:v2"  # bump when build_codelist_index output changes
 
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 FORMS_DIR.mkdir(parents=True, exist_ok=True)
 
 # import the functions from the modified modules
+import artifact_store as store_mod
 import comparison_spec as comp_mod
+import reconciliation as recon_mod
 import forms_combining as forms_mod
 import vault_migration as vault_mod
+import vault_session as session_mod
 
 app = Flask(__name__)
 CORS(app)
 app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB max upload
 
+def parse_subject_mappings(subjects):
+    # expected format: OLD1:NEW1,OLD2:NEW2  OR OLD1,OLD2 (if no new provided)
+    subject_mappings = []
+    if subjects:
+        for part in [p.strip() for p in subjects.split(",") if p.strip()]:
+            if ":" in part:
+                old, new = [x.strip() for x in part.split(":", 1)]
+                subject_mappings.append((old, new))
+            else:
+                subject_mappings.append((part, None))
+    return subject_mappings
+
+def guard_stream(subject_stream, errors):
+    # remember producer errors, the consumer (migrate_to_vault) catches everything
+    try:
+        yield from subject_stream
+    except Exception as e:
+        errors.append(e)
+        raise
+
 @app.route("/api/migrate", methods=["POST"])
 def api_migrate():
     try:
@@ -35,24 +59,20 @@ def api_migrate():
         if not study_id or not site_id or not site_country:
             return jsonify({"error": "Please provide studyId, siteId and siteCountry"}), 400
 
-        # parse subject mappings
-        # expected format: OLD1:NEW1,OLD2:NEW2  OR OLD1,OLD2 (if no new provided)
-        subject_mappings = []
-        if subjects:
-            for part in [p.strip() for p in subjects.split(",") if p.strip()]:
-                if ":" in part:
-                    old, new = [x.strip() for x in part.split(":", 1)]
-                    subject_mappings.append((old, new))
-                else:
-                    subject_mappings.append((part, None))
-
-        # file upload
+        subject_mappings = parse_subject_mappings(subjects)
+
+        # file upload: the target spec is stored under its content hash, never overwritten
         if "targetSpec" not in request.files:
             return jsonify({"error": "targetSpec file missing"}), 400
-        f = request.files["targetSpec"]
-        filename = secure_filename(f.filename) or "target_spec.xlsx"
-        target_spec_path = DATA_DIR / filename
-        f.save(str(target_spec_path))
+        spec_hash, target_spec_path, spec_known = store_mod.store_upload(
+            STORE_DIR, request.files["targetSpec"], kind="target_spec")
+
+        # form exports: optional bundle upload (zip and/or csv files), else the data/forms folder
+        bundle_files = [u for u in request.files.getlist("formsBundle") if u.filename]
+        if bundle_files:
+            forms_hash, forms_dir, _ = store_mod.store_forms_bundle(STORE_DIR, bundle_files)
+        else:
+            forms_hash, forms_dir = store_mod.hash_folder(FORMS_DIR), FORMS_DIR
 
         # required input: source_spec.xlsx must exist in data folder
         source_spec_path = DATA_DIR / "source_spec.xlsx"
@@ -60,49 +80,111 @@ def api_migrate():
             return jsonify({
                 "error": f"Source spec not found at {source_spec_path}. Place your source_spec.xlsx inside the data folder."
             }), 400
+        source_hash = store_mod.hash_file(source_spec_path)
 
-        # output paths (all inside data/)
-        comparison_result_file = DATA_DIR / "comparison_result.xlsx"
-        # per your request: comment placeholders for these (we set to None now)
-        source_spec_with_occurrence_file = "./data/source_spec_with_occurrence.xlsx"
-        target_spec_with_occurrence_file = "./data/target_spec_with_occurrence.xlsx"
+        store_mod.evict(STORE_DIR, keep=(spec_hash, forms_hash))
 
+        # output paths: derived products live in the store, the latest run is also copied to data/
+        comparison_key = f"comparison:{source_hash}"
+        transformed_key = f"transformed:v2:{forms_hash}:{source_hash}"
         transformed_output_file = DATA_DIR / "transformed_output.csv"
         # failed_items_output_file = DATA_DIR / "failed_items_output.txt"
         # output_log_file = DATA_DIR / "output_log.txt"
 
-        # 1) Compare specs
-        compare_res = comp_mod.compare_specifications(
-            source_spec_file=source_spec_path,
-            target_spec_file=target_spec_path,
-            comparison_result_file=comparison_result_file,
-            source_spec_with_occurrence_file=source_spec_with_occurrence_file,
-            target_spec_with_occurrence_file=target_spec_with_occurrence_file
-        )
-
-        # 2) Combine forms / transform
-        combine_res = forms_mod.combine_forms(
-            csv_source_folder=FORMS_DIR,
-            comparison_result_file=comparison_result_file,
-            target_spec_file=target_spec_path,
-            source_spec_with_occurrence_file=source_spec_with_occurrence_file,
-            target_spec_with_occurrence_file=target_spec_with_occurrence_file,
-            transformed_output_file=transformed_output_file
-        )
-
-        # 3) Migrate to Veeva Vault — only if environment variables are set
-        vault_config = {
-            "VAULT_DNS": "sb-cognizant-cdms.veevavault.com",
-            "API_VERSION": "v23.2",
-            "USERNAME": "Vigneshwaran.P_SD@sb-cognizant.com",
-            "PASSWORD": "Chennai@2025"
-        }
+        # 1) Compare specs (cached per target spec + source spec)
+        comparison = store_mod.get_derived(STORE_DIR, spec_hash, comparison_key)
+        if comparison is None:
+            out_dir = store_mod.derived_dir(STORE_DIR, spec_hash, comparison_key)
+            comparison_files = {
+                "comparison_result": out_dir / "comparison_result.xlsx",
+                "source_spec_with_occurrence": out_dir / "source_spec_with_occurrence.xlsx",
+                "target_spec_with_occurrence": out_dir / "target_spec_with_occurrence.xlsx",
+                "sample": out_dir / "comparison_sample.json",
+            }
+            compare_res = comp_mod.compare_specifications(
+                source_spec_file=source_spec_path,
+                target_spec_file=target_spec_path,
+                comparison_result_file=comparison_files["comparison_result"],
+                source_spec_with_occurrence_file=comparison_files["source_spec_with_occurrence"],
+                target_spec_with_occurrence_file=comparison_files["target_spec_with_occurrence"]
+            )
+            store_mod.write_json(comparison_files["sample"], compare_res)
+            store_mod.link_derived(STORE_DIR, spec_hash, comparison_key, comparison_files)
+        else:
+            print("Reusing cached comparison for target spec", spec_hash[:12])
+            comparison_files = comparison["files"]
+            compare_res = store_mod.read_json(comparison_files["sample"])
+        comparison_result_file = comparison_files["comparison_result"]
+        source_spec_with_occurrence_file = comparison_files["source_spec_with_occurrence"]
+        target_spec_with_occurrence_file = comparison_files["target_spec_with_occurrence"]
+        shutil.copyfile(comparison_result_file, DATA_DIR / "comparison_result.xlsx")
+
+        # codelist index of the target spec (cached per target spec)
+        codelists = store_mod.get_derived(STORE_DIR, spec_hash, CODELIST_INDEX_PRODUCT)
+        if codelists is None:
+            codelist_index = forms_mod.build_codelist_index(target_spec_path)
+            codelist_file = store_mod.derived_dir(STORE_DIR, spec_hash, CODELIST_INDEX_PRODUCT) / "codelist_index.json"
+            store_mod.write_json(codelist_file, codelist_index)
+            store_mod.link_derived(STORE_DIR, spec_hash, CODELIST_INDEX_PRODUCT, {"codelist_index": codelist_file})
+        else:
+            codelist_index = store_mod.read_json(codelists["files"]["codelist_index"])
+
+        # transformed output (cached per target spec + source spec + form exports)
+        transformed = store_mod.get_derived(STORE_DIR, spec_hash, transformed_key)
+        if transformed is not None:
+            print("Reusing cached transformed output for target spec", spec_hash[:12])
+            shutil.copyfile(transformed["files"]["transformed_output"], transformed_output_file)
+            combine_res = store_mod.read_json(transformed["files"]["summary"])
+
+        def store_transformed(summary):
+            # only cache a transform that ran to the end
+            if not summary.get("complete"):
+                return
+            out_dir = store_mod.derived_dir(STORE_DIR, spec_hash, transformed_key)
+            files = {"transformed_output": out_dir / "transformed_output.csv", "summary": out_dir / "combine_summary.json"}
+            shutil.copyfile(transformed_output_file, files["transformed_output"])
+            store_mod.write_json(files["summary"], summary)
+            store_mod.link_derived(STORE_DIR, spec_hash, transformed_key, files)
+
+        # 3) Migrate to Veeva Vault — only if credentials are configured (vault_config.json / env vars)
+        vault_config = session_mod.load_vault_config()
 
         if not (vault_config["VAULT_DNS"] and vault_config["USERNAME"] and vault_config["PASSWORD"]):
-            vault_res = {"skipped": True, "message": "Vault credentials not provided. Set VAULT_DNS, VAULT_USERNAME and VAULT_PASSWORD env vars to enable migration."}
+            # 2) Combine forms / transform
+            if transformed is None:
+                combine_res = forms_mod.combine_forms(
+                    csv_source_folder=forms_dir,
+                    comparison_result_file=comparison_result_file,
+                    target_spec_file=target_spec_path,
+                    source_spec_with_occurrence_file=source_spec_with_occurrence_file,
+                    target_spec_with_occurrence_file=target_spec_with_occurrence_file,
+                    transformed_output_file=transformed_output_file,
+                    codelist_index=codelist_index
+                )
+                store_transformed(combine_res)
+            vault_res = {"skipped": True, "message": "Vault credentials not provided. Set VAULT_DNS, VAULT_USERNAME and VAULT_PASSWORD env vars (or Backend/vault_config.json) to enable migration."}
+            vault_session_stats = None
         else:
+            # 2) Combine forms / transform, streamed subject by subject into the Vault stage
+            # (a cached transform is streamed back from the copied CSV the same way)
+            transform_errors = []
+            if transformed is not None:
+                subject_stream = forms_mod.iter_subjects_from_csv(transformed_output_file)
+            else:
+                combine_res = {}
+                subject_stream = guard_stream(forms_mod.prefetch_subjects(forms_mod.iter_transformed_subjects(
+                    csv_source_folder=forms_dir,
+                    comparison_result_file=comparison_result_file,
+                    target_spec_file=target_spec_path,
+                    source_spec_with_occurrence_file=source_spec_with_occurrence_file,
+                    target_spec_with_occurrence_file=target_spec_with_occurrence_file,
+                    transformed_output_file=transformed_output_file,
+                    summary=combine_res,
+                    codelist_index=codelist_index
+                )), transform_errors)
             old_subj_list = [s[0] for s in subject_mappings]
             new_subj_list = [(s[1] if s[1] else s[0]) for s in subject_mappings]
+            session_manager = session_mod.get_session_manager(vault_config, DATA_DIR / ".vault_session.json")
             vault_res = vault_mod.migrate_to_vault(
                 transformed_output_file=transformed_output_file,
                 STUDY_NAME=study_id,
@@ -112,8 +194,21 @@ def api_migrate():
                 new_subj_list=new_subj_list,
                 data_dir=DATA_DIR,
                 vault_config=vault_config,
-                target_spec=target_spec_path
+                target_spec=target_spec_path,
+                subject_frames=subject_stream,
+                session_manager=session_manager
             )
+            vault_session_stats = session_manager.stats()
+            if transformed is None:
+                # finish the transform (and the output file) for subjects the Vault stage did not consume
+                for _ in subject_stream:
+                    pass
+                # migrate_to_vault swallows errors, so transform failures are re-raised here (-> 500)
+                if transform_errors:
+                    raise transform_errors[0]
+                if not combine_res.get("complete"):
+                    raise RuntimeError("Transform of the form exports did not complete.")
+                store_transformed(combine_res)
 
         resp = {
             "comparison": {
@@ -124,8 +219,15 @@ def api_migrate():
                 "rows": combine_res.get("rows", 0),
                 "sample": combine_res.get("sample", [])
             },
-            "vault": vault_res
-            
+            "vault": vault_res,
+            "vaultSession": vault_session_stats,
+            "cache": {
+                "targetSpec": spec_hash,
+                "targetSpecKnown": spec_known,
+                "forms": forms_hash,
+                "comparison": comparison is not None,
+                "transformed": transformed is not None
+            }
         }
         print("My result",vault_res)
         
@@ -135,5 +237,96 @@ def api_migrate():
         print("Inside Exception:", str(e))
         return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
 
+@app.route("/api/reconcile", methods=["POST"])
+def api_reconcile():
+    try:
+        study_id = (request.form.get("studyId") or "").strip()
+        site_id = (request.form.get("siteId") or "").strip()
+        site_country = (request.form.get("siteCountry") or "").strip()
+        subject_mappings = parse_subject_mappings((request.form.get("subjects") or "").strip())
+        repush = (request.form.get("repush") or "").strip().lower() in ("1", "true", "yes")
+
+        if not study_id or not site_id or not site_country or not subject_mappings:
+            return jsonify({"error": "Please provide studyId, siteId, siteCountry and subjects"}), 400
+        if "targetSpec" not in request.files:
+            return jsonify({"error": "targetSpec file missing"}), 400
+        transformed_output_file = DATA_DIR / "transformed_output.csv"
+        if not transformed_output_file.exists():
+            return jsonify({"error": f"No transformed output at {transformed_output_file}. Run a migration first."}), 400
+
+        old_subj_list = [s[0] for s in subject_mappings]
+        new_subj_list = [(s[1] if s[1] else s[0]) for s in subject_mappings]
+        spec_hash, target_spec_path, _ = store_mod.store_upload(STORE_DIR, request.files["targetSpec"], kind="target_spec")
+        vault_config = session_mod.load_vault_config()
+        vault_configured = bool(vault_config["VAULT_DNS"] and vault_config["USERNAME"] and vault_config["PASSWORD"])
+
+        # Vault side: an uploaded data export (csv / zip, parsed offline) or a bulk read from Vault
+        export_files = [u for u in request.files.getlist("vaultExport") if u.filename]
+        if export_files:
+            codelists = store_mod.get_derived(STORE_DIR, spec_hash, CODELIST_INDEX_PRODUCT)
+            if codelists is None:
+                codelist_index = forms_mod.build_codelist_index(target_spec_path)
+            else:
+                codelist_index = store_mod.read_json(codelists["files"]["codelist_index"])
+            _, export_dir, _ = store_mod.store_forms_bundle(STORE_DIR, export_files)
+            vault_df = recon_mod.load_vault_export(export_dir, codelist_index=codelist_index)
+        elif vault_configured:
+            session_manager = session_mod.get_session_manager(vault_config, DATA_DIR / ".vault_session.json")
+            vault_df = recon_mod.fetch_vault_data(
+                base_url=f"https://{vault_config['VAULT_DNS']}/api/{vault_config['API_VERSION']}",
+                get_session_id=session_manager.get_session_id,
+                invalidate_session=session_manager.invalidate,
+                study_name=study_id,
+                study_country=site_country,
+                site=site_id,
+                subjects=new_subj_list
+            )
+        else:
+            return jsonify({"error": "Upload a Vault data export (vaultExport) or configure Vault credentials."}), 400
+
+        recon_res = recon_mod.reconcile(transformed_output_file, old_subj_list, new_subj_list, DATA_DIR, vault_df)
+
+        # targeted re-push: only the items that never reached Vault
+        repush_res = None
+        repushed = 0
+        if repush and recon_res["missing_frames"]:
+            if not vault_configured:
+                repush_res = {"skipped": True, "message": "Vault credentials not configured, cannot re-push."}
+            else:
+                repush_res = vault_mod.migrate_to_vault(
+                    transformed_output_file=None,
+                    STUDY_NAME=study_id,
+                    SITE_NUMBER=site_id,
+                    STUDY_COUNTRY=site_country,
+                    old_subj_list=old_subj_list,
+                    new_subj_list=new_subj_list,
+                    data_dir=DATA_DIR,
+                    vault_config=vault_config,
+                    target_spec=target_spec_path,
+                    subject_frames=recon_res["missing_frames"],
+                    repush=True
+                )
+                # items Vault accepted, not rows attempted (an aborted run returns its partial count)
+                repushed = repush_res.get("items_posted", 0)
+
+        return jsonify({
+            "counts": recon_res["counts"],
+            "sample": recon_res["sample"],
+            "repushed": repushed,
+            "vault": repush_res
+        })
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+
+@app.route("/api/vault/session", methods=["GET"])
+def api_vault_session():
+    # auth latency / keep-alive refresh counters of the shared Vault session in this process
+    vault_config = session_mod.load_vault_config()
+    if not (vault_config["VAULT_DNS"] and vault_config["USERNAME"] and vault_config["PASSWORD"]):
+        return jsonify({"configured": False})
+    session_manager = session_mod.get_session_manager(vault_config, DATA_DIR / ".vault_session.json")
+    return jsonify({"configured": True, "stats": session_manager.stats()})
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,312 @@
+# Backend/artifact_store.py
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from file_lock import file_lock
+
+CHUNK_SIZE = 1024 * 1024
+
+# retention / eviction limits (override with env vars)
+MAX_ARTIFACTS = int(os.environ.get("STORE_MAX_ARTIFACTS", 50))
+MAX_BYTES = int(os.environ.get("STORE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+MAX_AGE_DAYS = float(os.environ.get("STORE_MAX_AGE_DAYS", 30))
+
+_registry_lock = threading.Lock()
+
+
+def hash_file(path):
+    """sha256 of a file on disk, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_folder(folder, suffix=".csv"):
+    """
+    Digest of every file with the given suffix in folder (names + contents),
+    used for form CSVs placed in data/forms out of band.
+    """
+    folder = Path(folder)
+    digest = hashlib.sha256()
+    for filename in sorted(os.listdir(folder)):
+        if filename.lower().endswith(suffix):
+            digest.update(filename.encode("utf-8"))
+            digest.update(hash_file(folder / filename).encode("ascii"))
+    return digest.hexdigest()
+
+
+def _registry_path(store_dir):
+    return Path(store_dir) / "registry.json"
+
+
+@contextmanager
+def _registry_locked(store_dir):
+    """Serialise registry read-modify-write cycles across threads and worker processes."""
+    with _registry_lock, file_lock(Path(store_dir) / "registry.lock"):
+        yield
+
+
+def _load_registry(store_dir):
+    path = _registry_path(store_dir)
+    if not path.exists():
+        return {"artifacts": {}}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # a corrupt registry only costs us the cache
+        return {"artifacts": {}}
+
+
+def _save_registry(store_dir, registry):
+    path = _registry_path(store_dir)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix="registry.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(registry, f, indent=2)
+        os.replace(tmp_name, path)
+    except BaseException:
+        _remove_path(tmp_name)
+        raise
+
+
+def _path_size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def _remove_path(path):
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+
+def _spool_upload(store_dir, upload):
+    """Stream an upload into a private temp file while hashing it; returns (digest, temp path)."""
+    tmp_dir = Path(store_dir) / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_name = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, "wb") as out:
+        for chunk in iter(lambda: upload.stream.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest(), Path(tmp_name)
+
+
+def _save_object(store_dir, upload):
+    """Stream an uploaded file into objects/<aa>/<sha256><suffix>; returns (digest, path)."""
+    store_dir = Path(store_dir)
+    suffix = Path(upload.filename or "").suffix.lower()
+    digest, tmp_path = _spool_upload(store_dir, upload)
+
+    object_path = store_dir / "objects" / digest[:2] / f"{digest}{suffix}"
+    if object_path.exists():
+        os.remove(tmp_path)
+    else:
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, object_path)
+    return digest, object_path
+
+
+def _register(store_dir, digest, kind, name, path):
+    """Add (or touch) an artifact in the registry; returns True if it was already known."""
+    store_dir = Path(store_dir)
+    now = time.time()
+    with _registry_locked(store_dir):
+        registry = _load_registry(store_dir)
+        record = registry["artifacts"].get(digest)
+        known = record is not None and (store_dir / record["path"]).exists()
+        if known:
+            record["last_used"] = now
+        else:
+            registry["artifacts"][digest] = {
+                "kind": kind,
+                "name": name,
+                "path": str(Path(path).relative_to(store_dir)),
+                "size": _path_size(path),
+                "created": now,
+                "last_used": now,
+                "derived": {},
+            }
+        _save_registry(store_dir, registry)
+    return known
+
+
+def store_upload(store_dir, upload, kind):
+    """
+    Save an uploaded file (werkzeug FileStorage) under its content hash.
+    Returns (digest, path, known) where known is True when the same content
+    was uploaded before, so its derived products can be reused.
+    """
+    digest, object_path = _save_object(store_dir, upload)
+    known = _register(store_dir, digest, kind, upload.filename, object_path)
+    return digest, object_path, known
+
+
+def _unpack_bundle(uploads, spooled, target_dir):
+    """Copy the CSVs of every spooled upload (zip members or plain csv) into target_dir."""
+    for upload, (_, spool_path) in zip(uploads, spooled):
+        suffix = Path(upload.filename or "").suffix.lower()
+        if suffix == ".zip":
+            with zipfile.ZipFile(spool_path) as zf:
+                for member in zf.infolist():
+                    # flatten and keep only CSVs, never trust member paths
+                    member_name = os.path.basename(member.filename)
+                    if member.is_dir() or not member_name.lower().endswith(".csv"):
+                        continue
+                    with zf.open(member) as src, open(target_dir / member_name, "wb") as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        elif suffix == ".csv":
+            shutil.copyfile(spool_path, target_dir / os.path.basename(upload.filename))
+
+
+def store_forms_bundle(store_dir, uploads):
+    """
+    Save a form export bundle: one or more zip files and/or CSVs.
+    The CSVs are unpacked into bundles/<sha256>/ so the folder can be used as
+    csv_source_folder. Returns (digest, folder, known).
+    """
+    store_dir = Path(store_dir)
+    # raw uploads are only spooled for hashing / unpacking, the unpacked folder is what we keep
+    spooled = [_spool_upload(store_dir, upload) for upload in uploads]
+    try:
+        digest = hashlib.sha256("\n".join(sorted(d for d, _ in spooled)).encode("ascii")).hexdigest()
+
+        bundle_dir = store_dir / "bundles" / digest
+        if not bundle_dir.exists():
+            tmp_dir = Path(tempfile.mkdtemp(dir=store_dir / "tmp"))
+            try:
+                _unpack_bundle(uploads, spooled, tmp_dir)
+            except Exception:
+                _remove_path(tmp_dir)
+                raise
+            bundle_dir.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.replace(tmp_dir, bundle_dir)
+            except OSError:
+                # same bundle unpacked concurrently by another request
+                if not bundle_dir.exists():
+                    raise
+                _remove_path(tmp_dir)
+    finally:
+        for _, spool_path in spooled:
+            _remove_path(spool_path)
+
+    names = ", ".join(upload.filename or "" for upload in uploads)
+    known = _register(store_dir, digest, "forms_bundle", names, bundle_dir)
+    return digest, bundle_dir, known
+
+
+def write_json(path, obj):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, default=str)
+
+
+def read_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def derived_dir(store_dir, digest, product):
+    """Folder where the files of a derived product of artifact `digest` are written."""
+    path = Path(store_dir) / "derived" / digest / product.replace(":", "_")
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def get_derived(store_dir, digest, product):
+    """
+    Look up a derived product (e.g. "comparison:<source hash>") of an artifact.
+    Returns {"files": {name: Path}, "meta": {...}} or None when missing / incomplete.
+    """
+    store_dir = Path(store_dir)
+    with _registry_locked(store_dir):
+        registry = _load_registry(store_dir)
+        record = registry["artifacts"].get(digest)
+        entry = record and record["derived"].get(product)
+        if not entry:
+            return None
+        files = {name: store_dir / rel for name, rel in entry["files"].items()}
+        if not all(p.exists() for p in files.values()):
+            del record["derived"][product]
+            _save_registry(store_dir, registry)
+            return None
+        record["last_used"] = time.time()
+        _save_registry(store_dir, registry)
+    return {"files": files, "meta": entry.get("meta", {})}
+
+
+def link_derived(store_dir, digest, product, files, meta=None):
+    """Record derived files (name -> path inside the store) for artifact `digest`."""
+    store_dir = Path(store_dir)
+    with _registry_locked(store_dir):
+        registry = _load_registry(store_dir)
+        record = registry["artifacts"].get(digest)
+        if record is None:
+            return
+        record["derived"][product] = {
+            "files": {name: str(Path(p).relative_to(store_dir)) for name, p in files.items()},
+            "meta": meta or {},
+            "size": sum(_path_size(p) for p in files.values()),
+            "created": time.time(),
+        }
+        _save_registry(store_dir, registry)
+
+
+def evict(store_dir, keep=(), max_artifacts=None, max_bytes=None, max_age_days=None):
+    """
+    Apply retention limits: drop artifacts unused for max_age_days, then the
+    least recently used ones until both the count and total size limits hold.
+    Artifacts listed in keep (the ones the current request uses) are never removed.
+    Returns the list of evicted digests.
+    """
+    store_dir = Path(store_dir)
+    max_artifacts = MAX_ARTIFACTS if max_artifacts is None else max_artifacts
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    max_age_days = MAX_AGE_DAYS if max_age_days is None else max_age_days
+
+    def total_size(record):
+        return record.get("size", 0) + sum(d.get("size", 0) for d in record["derived"].values())
+
+    evicted = []
+    with _registry_locked(store_dir):
+        registry = _load_registry(store_dir)
+        artifacts = registry["artifacts"]
+        cutoff = time.time() - max_age_days * 24 * 3600
+        lru = sorted(artifacts, key=lambda d: artifacts[d]["last_used"])
+        used_bytes = sum(total_size(r) for r in artifacts.values())
+        count = len(artifacts)
+
+        for digest in lru:
+            if digest in keep:
+                continue
+            record = artifacts[digest]
+            if record["last_used"] >= cutoff and count <= max_artifacts and used_bytes <= max_bytes:
+                continue
+            _remove_path(store_dir / record["path"])
+            _remove_path(store_dir / "derived" / digest)
+            used_bytes -= total_size(record)
+            count -= 1
+            del artifacts[digest]
+            evicted.append(digest)
+
+        if evicted:
+            _save_registry(store_dir, registry)
+    if evicted:
+        print("Evicted from artifact store:", ", ".join(d[:12] for d in evicted))
+    return evicted
@@ -1,42 +1,109 @@
 # Backend/forms_combaining.py
 import os
 import re
+import queue
+import threading
 import pandas as pd
 from datetime import datetime
 from pathlib import Path
 
-def combine_forms(csv_source_folder, comparison_result_file, target_spec_file,
-                  source_spec_with_occurrence_file=None, target_spec_with_occurrence_file=None,
-                  transformed_output_file=None):
+# 'Item Data' values treated as empty: never sent to Vault and never expected back from it
+NULL_VALUES = ['', ' ', 'NAN', 'nan', 'None', None]
+
+def choice_key(value):
     """
-    csv_source_folder: folder containing CSVs (Path or string) - typically data/forms
-    comparison_result_file: path to comparison_result.xlsx (sheet 'Matched' expected)
-    target_spec_file: path to the target spec (for schedule/codelists)
-    transformed_output_file: path where transformed CSV will be written
+    Normalised codelist lookup key: labels and answers may come as str, int or float
+    (numeric scales), so 1, 1.0 and "1" all map to "1". None for empty values.
+    """
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def build_codelist_index(target_spec_file):
+    """
+    Index the target spec codelists per item name: {item_name: {choice_label: choice_code}}.
+    Items whose data type is not a (unit) codelist map to an empty dict.
+    The result is JSON serialisable so it can be cached next to the uploaded spec.
+    """
+    target_spec_file = Path(target_spec_file)
+    form_def_df = pd.read_excel(target_spec_file, sheet_name='Form Definitions', engine='openpyxl')
+    try:
+        codelist_df = pd.read_excel(target_spec_file, sheet_name='Codelists', engine='openpyxl')
+    except Exception:
+        codelist_df = pd.DataFrame()
+    try:
+        unit_codelist_df = pd.read_excel(target_spec_file, sheet_name='Unit Codelists', engine='openpyxl')
+    except Exception:
+        unit_codelist_df = pd.DataFrame()
+
+    def choices(df, code_list_name):
+        # keys normalised with choice_key so numeric labels match numeric answers; first match wins
+        result = {}
+        if pd.isna(code_list_name) or df.empty:
+            return result
+        for _, row in df[df['Name'] == code_list_name].iterrows():
+            label = row.get('Choice Label')
+            code = row.get('Choice Code')
+            key = choice_key(label.item() if hasattr(label, 'item') else label)
+            if key is not None and key not in result:
+                result[key] = code.item() if hasattr(code, 'item') else code
+        return result
+
+    index = {}
+    for _, item_row in form_def_df.drop_duplicates(subset=['Item Name']).iterrows():
+        item_name = item_row.get('Item Name')
+        if not isinstance(item_name, str):
+            continue
+        data_type = str(item_row.get('Data Type', ''))
+        codes = {}
+        if 'Codelist' in data_type:
+            codes.update(choices(codelist_df, item_row.get('Codelist')))
+        if 'Unit' in data_type:
+            for label, code in choices(unit_codelist_df, item_row.get('Unit Codelist')).items():
+                codes.setdefault(label, code)
+        index[item_name] = codes
+    return index
+
+
+def iter_transformed_subjects(csv_source_folder, comparison_result_file, target_spec_file,
+                              source_spec_with_occurrence_file=None, target_spec_with_occurrence_file=None,
+                              transformed_output_file=None, subjects=None, summary=None,
+                              codelist_index=None):
+    """
+    Generator version of combine_forms: yields (subject, DataFrame) as soon as
+    every form row of that subject has been transformed, so the Vault stage can
+    start on the first subject while later ones are still being processed.
+    - csv_source_folder: folder containing the form export CSVs (typically data/forms)
+    - transformed_output_file: optional CSV sink, appended to subject by subject
+    - subjects: optional list of subject ids to restrict the transform to
+    - summary: optional dict, filled with "rows" and "sample" while streaming
+    - codelist_index: optional cached result of build_codelist_index(target_spec_file)
     """
     csv_source_folder = Path(csv_source_folder)
     comparison_result_file = Path(comparison_result_file)
     target_spec_file = Path(target_spec_file)
-    transformed_output_file = Path(transformed_output_file)
     source_spec_with_occurrence_file = Path(source_spec_with_occurrence_file)
     target_spec_with_occurrence_file = Path(target_spec_with_occurrence_file)
-    
+    if transformed_output_file is not None:
+        transformed_output_file = Path(transformed_output_file)
+    if summary is None:
+        summary = {}
+    summary["rows"] = 0
+    summary["sample"] = []
+    summary["complete"] = False
+
     print("Combining form CSVs from:", csv_source_folder)
 
     # read helper spec files
     # source_spec_with_occurrence_file and target_spec_with_occurrence_file are optional
     source_df = pd.read_excel(source_spec_with_occurrence_file)
     target_df = pd.read_excel(target_spec_with_occurrence_file)
-    # target spec used for form definitions / codelists
-    form_def_df = pd.read_excel(target_spec_file, sheet_name='Form Definitions', engine='openpyxl')
-    try:
-        codelist_df = pd.read_excel(target_spec_file, sheet_name='Codelists', engine='openpyxl')
-    except Exception:
-        codelist_df = pd.DataFrame()
-    try:
-        unit_codelist_df = pd.read_excel(target_spec_file, sheet_name='Unit Codelists', engine='openpyxl')
-    except Exception:
-        unit_codelist_df = pd.DataFrame()
+    # target spec used for codelists
+    if codelist_index is None:
+        codelist_index = build_codelist_index(target_spec_file)
 
     # matched mapping produced by comparison_spec
     matched_df = pd.read_excel(comparison_result_file, sheet_name='Matched', engine='openpyxl')
@@ -47,7 +114,6 @@ def combine_forms(csv_source_folder, comparison_result_file, target_spec_file,
         event_order = schedule_df.iloc[1].dropna().tolist()
     except Exception:
         event_order = []
-    transformed_data = []
 
     def get_event_details(event_label, form_label):
             source_match = source_df[(source_df['Event'] == event_label) & (source_df['Form'] == form_label)]
@@ -60,27 +126,60 @@ def combine_forms(csv_source_folder, comparison_result_file, target_spec_file,
             return target_match[['Event Group', 'Event Group Name', 'Event', 'Event Name']]
 
     def get_choice_code(item_name, choice_label):
-        if form_def_df is None or form_def_df.empty:
+        codes = codelist_index.get(item_name)
+        if codes is None:
             return None
-        item_row = form_def_df[form_def_df['Item Name'] == item_name]
-        if not item_row.empty:
-            data_type = item_row.iloc[0].get('Data Type', '')
-            if 'Codelist' in str(data_type):
-                code_list_name = item_row.iloc[0].get('Codelist')
-                if not pd.isna(code_list_name) and not codelist_df.empty:
-                    match_row = codelist_df[(codelist_df['Name'] == code_list_name) & (codelist_df['Choice Label'] == choice_label)]
-                    if not match_row.empty:
-                        return match_row.iloc[0].get('Choice Code')
-            if 'Unit' in str(data_type):
-                code_list_name = item_row.iloc[0].get('Unit Codelist')
-                if not pd.isna(code_list_name) and not unit_codelist_df.empty:
-                    match_row = unit_codelist_df[(unit_codelist_df['Name'] == code_list_name) & (unit_codelist_df['Choice Label'] == choice_label)]
-                    if not match_row.empty:
-                        return match_row.iloc[0].get('Choice Code')
-            return "Not codelist"
-        return None
+        key = choice_key(choice_label)
+        return codes.get(key, "Not codelist") if key is not None else "Not codelist"
+
+    def transform_rows(csv_df, col, item_name, item_group, form_name):
+        rows = []
+        for _, csv_row in csv_df.iterrows():
+            # event_label = csv_row.get('Event Label')
+            form_label = csv_row.get('Form Label')
+            event_details = get_event_details(csv_row.get('Event Label'), csv_row.get('Form Label'))
+            # attempt to find occurrence via event/form (this logic expects presence of occurrence files; it's kept simple)
+            item_data = get_choice_code(item_name, csv_row.get(col))
+            if item_data == "Not codelist":
+                item_data = csv_row.get(col, "")
+
+            # normalize item_data
+            try:
+                parsed_date = datetime.strptime(str(item_data).strip(), "%d-%m-%Y")
+                item_data = parsed_date.strftime("%Y-%m-%d")
+            except Exception:
+                # leave as string trim
+                if isinstance(item_data, float) and item_data.is_integer():
+                    item_data = str(int(item_data))
+                else:
+                    item_data = str(item_data).strip()
+
+            # event details are simplified here
+            if event_details is not None and item_data is not None:
+                event_gl, event_gn, event_la, event_n = event_details.iloc[0]
+                rows.append({
+                    "Study": csv_row.get("Study", ""),
+                    "Study Country": csv_row.get("Study Country", ""),
+                    "Study Site": csv_row.get("Study Site", ""),
+                    "Subject": csv_row.get("Subject", ""),
+                    "Event Group Label": event_gl,
+                    "Event Group Name": event_gn,
+                    "Event Label": event_la,
+                    "Event Name": event_n,
+                    "Form Label": form_label,
+                    "Form Name": form_name,
+                    "Form Status": csv_row.get("Form Status", ""),
+                    "Item Group": item_group,
+                    "Item Name": item_name,
+                    "Item Data": item_data,
+                    "Event Date": csv_row.get("Event Date", "")
+                })
+        return rows
 
-    # iterate CSVs in source folder
+    # read every CSV up front (cheap compared to the transform) and split it per subject,
+    # keeping the column -> matched item mapping so each subject can be transformed on its own
+    form_plans = []
+    all_subjects = []
     for filename in os.listdir(csv_source_folder):
         if filename.lower().endswith(".csv"):
             csv_path = csv_source_folder / filename
@@ -96,6 +195,7 @@ def combine_forms(csv_source_folder, comparison_result_file, target_spec_file,
             dominant_form_label = csv_df['Form Label'].mode()[0] if not csv_df['Form Label'].mode().empty else None
             matched_rows = matched_df[matched_df['Form Label'] == dominant_form_label].dropna()
 
+            column_items = []
             for col in csv_df.columns:
                 m = re.search(r"\(([^)]+)\)$", col)
                 if m:
@@ -106,62 +206,171 @@ def combine_forms(csv_source_folder, comparison_result_file, target_spec_file,
                         item_group = matched_row.get('Item Group Name', '')
                         form_name = matched_row.get('Form Name', '')
                         if csv_item_name == str(item_name).strip().lower():
-                            for _, csv_row in csv_df.iterrows():
-                                # event_label = csv_row.get('Event Label')
-                                form_label = csv_row.get('Form Label')
-                                event_details = get_event_details(csv_row.get('Event Label'), csv_row.get('Form Label'))
-                                # attempt to find occurrence via event/form (this logic expects presence of occurrence files; it's kept simple)
-                                item_data = get_choice_code(item_name, csv_row.get(col))
-                                if item_data == "Not codelist":
-                                    item_data = csv_row.get(col, "")
-
-                                # normalize item_data
-                                try:
-                                    parsed_date = datetime.strptime(str(item_data).strip(), "%d-%m-%Y")
-                                    item_data = parsed_date.strftime("%Y-%m-%d")
-                                except Exception:
-                                    # leave as string trim
-                                    if isinstance(item_data, float) and item_data.is_integer():
-                                        item_data = str(int(item_data))
-                                    else:
-                                        item_data = str(item_data).strip()
-
-                                # event details are simplified here
-                                if event_details is not None and item_data is not None:
-                                    event_gl, event_gn, event_la, event_n = event_details.iloc[0]
-                                    transformed_data.append({
-                                        "Study": csv_row.get("Study", ""),
-                                        "Study Country": csv_row.get("Study Country", ""),
-                                        "Study Site": csv_row.get("Study Site", ""),
-                                        "Subject": csv_row.get("Subject", ""),
-                                        "Event Group Label": event_gl,
-                                        "Event Group Name": event_gn,
-                                        "Event Label": event_la,
-                                        "Event Name": event_n,
-                                        "Form Label": form_label,
-                                        "Form Name": form_name,
-                                        "Form Status": csv_row.get("Form Status", ""),
-                                        "Item Group": item_group,
-                                        "Item Name": item_name,
-                                        "Item Data": item_data,
-                                        "Event Date": csv_row.get("Event Date", "")
-                                    })
-
-    final_df = pd.DataFrame(transformed_data)
-    if event_order:
+                            column_items.append((col, item_name, item_group, form_name))
+            if not column_items:
+                continue
+
+            if 'Subject' in csv_df.columns:
+                subject_groups = {(None if pd.isna(subj) else subj): grp
+                                  for subj, grp in csv_df.groupby('Subject', sort=False, dropna=False)}
+            else:
+                subject_groups = {None: csv_df}
+            for subj in subject_groups:
+                if subj not in all_subjects:
+                    all_subjects.append(subj)
+            form_plans.append((subject_groups, column_items))
+
+    # same order the combined output was sorted by: subject ascending, missing subjects last
+    subject_order = sorted(all_subjects, key=lambda s: (s is None, str(s)))
+    if subjects is not None:
+        wanted = set(subjects)
+        subject_order = [s for s in subject_order if s in wanted]
+
+    header_written = False
+    for subj in subject_order:
+        transformed_data = []
+        for subject_groups, column_items in form_plans:
+            subj_df = subject_groups.get(subj)
+            if subj_df is None:
+                continue
+            for col, item_name, item_group, form_name in column_items:
+                transformed_data.extend(transform_rows(subj_df, col, item_name, item_group, form_name))
+        if not transformed_data:
+            continue
+
+        subject_df = pd.DataFrame(transformed_data)
+        if event_order:
+            try:
+                subject_df['Event Label'] = pd.Categorical(subject_df['Event Label'], categories=event_order, ordered=True)
+            except Exception:
+                pass
+        subject_df = subject_df.sort_values('Event Label', kind='stable')
+
+        if transformed_output_file is not None:
+            subject_df.to_csv(transformed_output_file, mode='a' if header_written else 'w',
+                              header=not header_written, index=False)
+            header_written = True
+        summary["rows"] += len(subject_df)
+        if len(summary["sample"]) < 200:
+            summary["sample"].extend(subject_df.head(200 - len(summary["sample"])).to_dict(orient="records"))
+
+        yield subj, subject_df
+
+    # keep the previous behaviour of always producing the output file, even when empty
+    if transformed_output_file is not None and not header_written:
+        pd.DataFrame().to_csv(transformed_output_file, index=False)
+    summary["complete"] = True
+
+
+def read_transformed_output(transformed_output_file):
+    """
+    Read a transformed output CSV back with every value kept as written ("007",
+    "NA", "None" and numeric subject ids stay strings); only empty cells are NaN.
+    """
+    return pd.read_csv(transformed_output_file, dtype=str, keep_default_na=False, na_values=[''])
+
+
+def iter_subjects_from_csv(transformed_output_file, subjects=None):
+    """
+    Yield (subject, DataFrame) from an existing transformed output CSV (e.g. a cached
+    transform) in file order, like iter_transformed_subjects does for a fresh one.
+    - subjects: optional list of subject ids to restrict the stream to
+    """
+    target_data = read_transformed_output(transformed_output_file)
+    if target_data.empty or 'Subject' not in target_data.columns:
+        return
+    if subjects is not None:
+        target_data = target_data[target_data['Subject'].isin(subjects)]
+    for subj, subject_df in target_data.groupby('Subject', sort=False):
+        yield subj, subject_df
+
+
+class _PrefetchedSubjects:
+    """Iterator side of prefetch_subjects; close() (or garbage collection) stops the producer."""
+
+    _DONE = object()
+
+    def __init__(self, subject_stream, max_buffered):
+        self._buffer = queue.Queue(maxsize=max_buffered)
+        self._stop = threading.Event()
+        self._finished = False
+        # the thread only sees the buffer and the stop flag, never self, so __del__ can run
+        self._worker = threading.Thread(target=self._produce, args=(subject_stream, self._buffer, self._stop),
+                                        name="subject-prefetch", daemon=True)
+        self._worker.start()
+
+    @classmethod
+    def _produce(cls, subject_stream, buffer, stop):
+        def offer(entry):
+            while not stop.is_set():
+                try:
+                    buffer.put(entry, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
         try:
-            final_df['Event Label'] = pd.Categorical(final_df['Event Label'], categories=event_order, ordered=True)
-        except Exception:
-            pass
-
-    # sort and write output CSV
-    grouped_sorted_df = final_df.sort_values(['Subject', 'Event Label']) if not final_df.empty else final_df
-    grouped_sorted_df.to_csv(transformed_output_file, index=False)
-
-    return {
-        "rows": len(grouped_sorted_df),
-        "sample": grouped_sorted_df.head(200).to_dict(orient="records")
-    }
+            for entry in subject_stream:
+                if not offer(entry):
+                    return
+            offer(cls._DONE)
+        except BaseException as e:
+            offer(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        entry = self._buffer.get()
+        if entry is self._DONE:
+            self.close()
+            raise StopIteration
+        if isinstance(entry, BaseException):
+            self.close()
+            raise entry
+        return entry
+
+    def close(self):
+        self._finished = True
+        self._stop.set()
+
+    def __del__(self):
+        self.close()
+
+
+def prefetch_subjects(subject_stream, max_buffered=2):
+    """
+    Run a subject stream (e.g. iter_transformed_subjects) in a background thread,
+    buffering at most max_buffered subjects, so transforming the next subject
+    overlaps with the consumer's network calls for the current one.
+    The producer starts right away (so the transform runs while the consumer is still
+    authenticating / loading specs) and stops when the returned iterator is exhausted,
+    closed or garbage collected. Exceptions raised by the producer are re-raised in the consumer.
+    """
+    return _PrefetchedSubjects(subject_stream, max_buffered)
+
+
+def combine_forms(csv_source_folder, comparison_result_file, target_spec_file,
+                  source_spec_with_occurrence_file=None, target_spec_with_occurrence_file=None,
+                  transformed_output_file=None, codelist_index=None):
+    """
+    csv_source_folder: folder containing CSVs (Path or string) - typically data/forms
+    comparison_result_file: path to comparison_result.xlsx (sheet 'Matched' expected)
+    target_spec_file: path to the target spec (for schedule/codelists)
+    transformed_output_file: path where transformed CSV will be written (optional)
+    """
+    summary = {}
+    for _ in iter_transformed_subjects(csv_source_folder, comparison_result_file, target_spec_file,
+                                       source_spec_with_occurrence_file=source_spec_with_occurrence_file,
+                                       target_spec_with_occurrence_file=target_spec_with_occurrence_file,
+                                       transformed_output_file=transformed_output_file,
+                                       summary=summary,
+                                       codelist_index=codelist_index):
+        pass
+    return summary
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,220 @@
+# Backend/reconciliation.py
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urljoin
+
+import pandas as pd
+import requests
+
+from forms_combining import NULL_VALUES, read_transformed_output
+from vault_session import is_invalid_session
+
+KEY_COLUMNS = ['Subject', 'Event Name', 'Form Name', 'Item Group', 'Item Name']
+
+# "<label> (ig_AE_F.AEREFID)" -> item group, item name; "<label> (...)_RAW" columns are skipped
+ITEM_COLUMN_RE = re.compile(r"\(([^().]+)\.([^()]+)\)$")
+DMY_DATE_RE = r"^\d{2}-\d{2}-\d{4}$"
+
+
+def normalize_values(values):
+    """
+    Vectorized normalisation so both sides compare equal when Vault stored the
+    same value: trimmed strings, dd-mm-yyyy dates as yyyy-mm-dd, "3.0" as "3",
+    and empty markers as NA.
+    """
+    values = values.astype("string").str.strip()
+    values = values.mask(values.isin(NULL_VALUES))
+    is_dmy = values.str.match(DMY_DATE_RE).fillna(False).astype(bool)
+    if is_dmy.any():
+        parsed = pd.to_datetime(values[is_dmy], format="%d-%m-%Y", errors="coerce")
+        values.loc[is_dmy] = parsed.dt.strftime("%Y-%m-%d").where(parsed.notna(), values[is_dmy])
+    return values.str.replace(r"^(-?\d+)\.0+$", r"\1", regex=True)
+
+
+def _read_export_csvs(export_path):
+    export_path = Path(export_path)
+    if export_path.is_dir():
+        for filename in sorted(os.listdir(export_path)):
+            if filename.lower().endswith(".csv"):
+                yield pd.read_csv(export_path / filename, dtype=str)
+    elif export_path.suffix.lower() == ".zip":
+        with zipfile.ZipFile(export_path) as zf:
+            for member in zf.namelist():
+                if member.lower().endswith(".csv"):
+                    with zf.open(member) as f:
+                        yield pd.read_csv(f, dtype=str)
+    else:
+        yield pd.read_csv(export_path, dtype=str)
+
+
+def load_vault_export(export_path, codelist_index=None):
+    """
+    Parse a Vault data export (a CSV, a folder of CSVs or a zip) in the same wide
+    format as the data/forms files into one long frame with KEY_COLUMNS + 'Item Data'.
+    Exports show codelist labels, so pass the target spec codelist index
+    (forms_combining.build_codelist_index) to compare against the stored codes.
+    """
+    frames = []
+    for export_df in _read_export_csvs(export_path):
+        item_columns = {col: ITEM_COLUMN_RE.search(col) for col in export_df.columns}
+        item_columns = {col: m.groups() for col, m in item_columns.items() if m}
+        if not item_columns or 'Subject' not in export_df.columns:
+            continue
+        id_columns = [c for c in ['Subject', 'Event Name', 'Form Name'] if c in export_df.columns]
+        long_df = export_df[id_columns + list(item_columns)].melt(
+            id_vars=id_columns, var_name='column', value_name='Item Data')
+        long_df['Item Group'] = long_df['column'].map({c: g.strip() for c, (g, _) in item_columns.items()})
+        long_df['Item Name'] = long_df['column'].map({c: i.strip() for c, (_, i) in item_columns.items()})
+        frames.append(long_df.drop(columns=['column']))
+
+    if not frames:
+        return pd.DataFrame(columns=KEY_COLUMNS + ['Item Data'])
+    vault_df = pd.concat(frames, ignore_index=True).reindex(columns=KEY_COLUMNS + ['Item Data'])
+
+    if codelist_index:
+        codes = pd.DataFrame(
+            [(item, label, code) for item, choices in codelist_index.items() for label, code in choices.items()],
+            columns=['Item Name', 'label', 'code'])
+        # index keys are normalised (forms_combining.choice_key), export values are strings
+        vault_df['label'] = vault_df['Item Data'].str.strip()
+        vault_df = vault_df.merge(codes, on=['Item Name', 'label'], how='left')
+        vault_df['Item Data'] = vault_df['code'].where(vault_df['code'].notna(), vault_df['Item Data'])
+        vault_df = vault_df.drop(columns=['code', 'label'])
+    return vault_df
+
+
+def fetch_vault_data(base_url, get_session_id, study_name, study_country, site, subjects, max_workers=8,
+                     invalidate_session=None):
+    """
+    Bulk-read the migrated subjects back from Vault: one paginated "retrieve forms"
+    read per subject, subjects fetched concurrently.
+    - base_url: e.g. https://<dns>/api/<version>, or a local fake for offline runs
+    - get_session_id: callable returning a valid session id (VaultSessionManager.get_session_id)
+    - invalidate_session: optional callable (VaultSessionManager.invalidate) used to drop a
+      session Vault rejects before retrying the page once
+    Any page that is not a SUCCESS raises, so a failed read never looks like an empty subject.
+    """
+    local = threading.local()
+
+    def fetch_subject(subj):
+        if not hasattr(local, "http"):
+            local.http = requests.Session()
+        rows = []
+        url = f"{base_url}/app/cdm/forms"
+        params = {"study_name": study_name, "study_country": study_country, "site": site, "subject": subj}
+        while url:
+            for attempt in range(2):
+                session_id = get_session_id()
+                headers = {'Accept': 'application/json', 'Authorization': session_id}
+                response = local.http.get(url, headers=headers, params=params)
+                response.raise_for_status()
+                response_data = response.json()
+                if attempt == 0 and invalidate_session is not None and is_invalid_session(response_data):
+                    invalidate_session(session_id)
+                    continue
+                break
+            if response_data.get("responseStatus") != "SUCCESS":
+                raise RuntimeError(f"Vault read failed for subject {subj}: "
+                                   f"{response_data.get('errors') or response_data.get('responseMessage')}")
+            for form in response_data.get("forms", []):
+                # items come nested per item group, or flat with their itemgroup_name
+                itemgroups = form.get("itemgroups") or [{"items": form.get("items", [])}]
+                for itemgroup in itemgroups:
+                    for item in itemgroup.get("items", []):
+                        rows.append((subj, form.get("event_name"), form.get("form_name"),
+                                     item.get("itemgroup_name") or itemgroup.get("itemgroup_name"),
+                                     item.get("item_name"), item.get("value")))
+            next_page = (response_data.get("responseDetails") or {}).get("next_page")
+            url, params = (urljoin(base_url + "/", next_page), None) if next_page else (None, None)
+        return rows
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(fetch_subject, subjects))
+    return pd.DataFrame([row for rows in results for row in rows], columns=KEY_COLUMNS + ['Item Data'])
+
+
+def load_transformed_output(transformed_output_file, old_subj_list, new_subj_list):
+    """
+    Read transformed_output.csv the way migrate_to_vault sends it: only mapped subjects,
+    only non-empty values, one value per (event, form, item, subject); subjects renamed
+    to their Vault ids. Keeps 'Old Subject' so missing items can be re-pushed.
+    """
+    target_data = read_transformed_output(transformed_output_file)
+    target_data = target_data[target_data['Item Data'].notna() & ~target_data['Item Data'].isin(NULL_VALUES)]
+    target_data = target_data.drop_duplicates(subset=['Event Name', 'Form Name', 'Item Name', 'Subject'])
+
+    mapping = pd.DataFrame({
+        'Subject': [old_subj_list[i] if i < len(old_subj_list) else old_subj_list[0] for i in range(len(new_subj_list))],
+        'Vault Subject': new_subj_list,
+    })
+    target_data = target_data.merge(mapping, on='Subject', how='inner')
+    return target_data.rename(columns={'Subject': 'Old Subject', 'Vault Subject': 'Subject'})
+
+
+def diff_against_vault(transformed_df, vault_df):
+    """
+    Outer-join both sides on KEY_COLUMNS and classify every value as
+    matched / mismatched / missing (not in Vault) / extra (only in Vault).
+    Returns (diff DataFrame, counts dict).
+    """
+    expected = transformed_df[KEY_COLUMNS + ['Item Data']].copy()
+    expected['Item Data'] = normalize_values(expected['Item Data'])
+    actual = vault_df[KEY_COLUMNS + ['Item Data']].copy()
+    actual['Item Data'] = normalize_values(actual['Item Data'])
+    actual = actual[actual['Item Data'].notna()].drop_duplicates(subset=KEY_COLUMNS)
+    for df in (expected, actual):
+        df[KEY_COLUMNS] = df[KEY_COLUMNS].astype("string").apply(lambda col: col.str.strip())
+
+    diff = expected.merge(actual, on=KEY_COLUMNS, how='outer', suffixes=(' Expected', ' Vault'), indicator=True)
+    diff['Status'] = 'matched'
+    diff.loc[diff['_merge'] == 'left_only', 'Status'] = 'missing'
+    diff.loc[diff['_merge'] == 'right_only', 'Status'] = 'extra'
+    both = diff['_merge'] == 'both'
+    diff.loc[both & (diff['Item Data Expected'] != diff['Item Data Vault']).fillna(True), 'Status'] = 'mismatched'
+    diff = diff.drop(columns=['_merge'])
+
+    counts = diff['Status'].value_counts().to_dict()
+    counts = {status: int(counts.get(status, 0)) for status in ['matched', 'mismatched', 'missing', 'extra']}
+    counts['expected'] = len(expected)
+    return diff, counts
+
+
+def missing_subject_frames(transformed_df, diff):
+    """
+    Rows of the transformed output whose value never reached Vault, grouped as
+    (old subject, DataFrame) so they can be passed to migrate_to_vault(subject_frames=...).
+    """
+    missing_keys = diff.loc[diff['Status'] == 'missing', KEY_COLUMNS]
+    keyed = transformed_df.copy()
+    keyed[KEY_COLUMNS] = keyed[KEY_COLUMNS].astype("string").apply(lambda col: col.str.strip())
+    missing = keyed.merge(missing_keys, on=KEY_COLUMNS, how='inner')
+    missing = missing.drop(columns=['Subject']).rename(columns={'Old Subject': 'Subject'})
+    return [(subj, group) for subj, group in missing.groupby('Subject', sort=True)]
+
+
+def reconcile(transformed_output_file, old_subj_list, new_subj_list, data_dir, vault_df):
+    """
+    Diff transformed_output.csv against data read back from Vault (see load_vault_export /
+    fetch_vault_data). Writes data_dir/reconciliation_diff.csv (every non-matched value)
+    and returns the counts, a sample and the missing items ready to re-push.
+    """
+    data_dir = Path(data_dir)
+    transformed_df = load_transformed_output(transformed_output_file, old_subj_list, new_subj_list)
+    # an export may cover the whole study, only the migrated subjects are reconciled
+    vault_df = vault_df[vault_df['Subject'].isin(new_subj_list)]
+    diff, counts = diff_against_vault(transformed_df, vault_df)
+
+    reconciliation_file = data_dir / "reconciliation_diff.csv"
+    problems = diff[diff['Status'] != 'matched']
+    problems.to_csv(reconciliation_file, index=False)
+    print("Reconciliation:", counts, "- details in", reconciliation_file)
+
+    return {
+        "counts": counts,
+        "sample": problems.head(200).astype(object).where(problems.head(200).notna(), None).to_dict(orient="records"),
+        "missing_frames": missing_subject_frames(transformed_df, diff),
+    }
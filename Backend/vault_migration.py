@@ -6,21 +6,34 @@ from datetime import datetime
 from collections import OrderedDict
 from pathlib import Path
 
+from forms_combining import NULL_VALUES, iter_subjects_from_csv
+from vault_session import get_session_manager, is_invalid_session
+
 def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COUNTRY,
-                     old_subj_list, new_subj_list, data_dir: Path, vault_config: dict,target_spec):
+                     old_subj_list, new_subj_list, data_dir: Path, vault_config: dict,target_spec,
+                     subject_frames=None, session_manager=None, repush=False):
     """
-    transformed_output_file: path to CSV (Path or string)
+    transformed_output_file: path to CSV (Path or string), read only when subject_frames is None
+    subject_frames: optional iterable of (old subject, DataFrame) as yielded by
+                    forms_combining.iter_transformed_subjects; each subject is sent to Vault
+                    as soon as it arrives instead of waiting for the whole CSV
     old_subj_list / new_subj_list: lists (must be same length) for subject mapping
     data_dir: Path to data folder where logs will be written
     vault_config: dict with keys VAULT_DNS, API_VERSION, USERNAME, PASSWORD
+    session_manager: optional vault_session.VaultSessionManager; by default the process-wide
+                     manager for this Vault user, sharing its session through data_dir
+    repush: only set the given items on forms that already exist in Vault (e.g. the missing
+            items found by reconciliation): no event dates, no new repeating forms, and the
+            logs go to repush_failed_items.txt / repush_output_log.txt so the migration logs are kept
+    Returns {"items_posted": <items Vault accepted>, "completed": <False if the run was aborted>}.
     """
 
     data_dir = Path(data_dir)
-    TRANSFORMED_OUTPUT_FILE = Path(transformed_output_file)
+    TRANSFORMED_OUTPUT_FILE = Path(transformed_output_file) if transformed_output_file is not None else None
     TARGET_SPEC_FILE=Path(target_spec)
 
-    FAILED_ITEMS_OUTPUT_FILE = data_dir / "failed_items_output.txt"
-    OUTPUT_LOG_FILE = data_dir / "output_log.txt"
+    FAILED_ITEMS_OUTPUT_FILE = data_dir / ("repush_failed_items.txt" if repush else "failed_items_output.txt")
+    OUTPUT_LOG_FILE = data_dir / ("repush_output_log.txt" if repush else "output_log.txt")
 
     # if config incomplete -> skip
     if not (vault_config.get("VAULT_DNS") and vault_config.get("USERNAME") and vault_config.get("PASSWORD")):
@@ -28,19 +41,32 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
 
     VAULT_DNS = vault_config["VAULT_DNS"]
     API_VERSION = vault_config.get("API_VERSION", "v23.2")
-    USERNAME = vault_config["USERNAME"]
-    PASSWORD = vault_config["PASSWORD"]
+    if session_manager is None:
+        session_manager = get_session_manager(vault_config, data_dir / ".vault_session.json")
 
     failure_lines = []
     failure_itemgs = []
+    run_stats = {"items_posted": 0, "completed": False}
+
+    replaced_sessions = {}  # rejected session id -> the one that replaced it
 
-    def authenticate():
-        url = f"https://{VAULT_DNS}/api/{API_VERSION}/auth"
-        data = {"username": USERNAME, "password": PASSWORD}
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        print("Authentication successful.")
-        return response.json()["sessionId"]
+    def vault_request(method, url, headers, **kwargs):
+        # Vault reports a dead session as a 200 FAILURE: drop it from the shared cache and retry once
+        session_id = headers['Authorization']
+        if session_id in replaced_sessions:
+            headers = dict(headers, Authorization=replaced_sessions[session_id])
+        response = requests.request(method, url, headers=headers, **kwargs)
+        try:
+            invalid = is_invalid_session(response.json())
+        except ValueError:
+            invalid = False
+        if invalid:
+            print("Vault session rejected (INVALID_SESSION_ID), re-authenticating.")
+            session_manager.invalidate(headers['Authorization'])
+            replaced_sessions[session_id] = session_manager.get_session_id()
+            headers = dict(headers, Authorization=replaced_sessions[session_id])
+            response = requests.request(method, url, headers=headers, **kwargs)
+        return response
 
     def get_event(eg):
         temp_spec=design_spec[design_spec['Event Group Name']==eg]
@@ -67,14 +93,14 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
             }]
         }
         headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': session_id}
-        response = requests.post(url, headers=headers, json=payload)
+        response = vault_request("POST", url, headers, json=payload)
         #print("Set Event Date Response:", response.json())
         extract_failed_items(response.json())
 
     def get_forms(session_id, subj_id, event_group, event_name):
         url = f"https://{VAULT_DNS}/api/{API_VERSION}/app/cdm/forms?study_name={STUDY_NAME}&study_country={STUDY_COUNTRY}&site={SITE_NUMBER}&subject={subj_id}&eventgroup_name={event_group}&event_name={event_name}"
         headers = {'Authorization': session_id, 'Content-Type': 'application/json'}
-        response = requests.get(url, headers=headers)
+        response = vault_request("GET", url, headers)
         response_data = response.json()
         return list(set([form.get("form_name") for form in response_data.get("forms", [])]))
         
@@ -139,8 +165,9 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
         if forms_payload:
             payload = json.dumps({"study_name": STUDY_NAME, "forms": forms_payload}, indent=2)
             headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': session_id}
-            response = requests.post(url, headers=headers, data=payload)
+            response = vault_request("POST", url, headers, data=payload)
             response_json = response.json()
+            run_stats["items_posted"] += sum(1 for item in response_json.get("items", []) if item.get("responseStatus") == "SUCCESS")
             extract_failed_items(response_json,data_df,session_id)
             submit_form(session_id, subj_id, event_group, event_name, data_forms)
 
@@ -150,7 +177,7 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
                             "eventgroup_name": event_group, "event_name": event_name, "form_name": fn} for fn in form_names]
         payload = json.dumps({"study_name": STUDY_NAME, "forms": forms_to_submit})
         headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': session_id}
-        response = requests.post(url, headers=headers, data=payload)
+        response = vault_request("POST", url, headers, data=payload)
         response_json = response.json()
         #print("Submit Form Response:", response_json)
         extract_failed_items(response_json)
@@ -201,7 +228,7 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
         ]
         })
         headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': session_id}
-        response = requests.post(url, headers=headers, data=payload)
+        response = vault_request("POST", url, headers, data=payload)
         #response_json = response.json()
         #print("trigger itemgs Response:", response_json)
 
@@ -226,7 +253,7 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
         })
 
         headers = {'Accept': 'application/json', 'Content-Type': 'application/json', 'Authorization': session_id}
-        response = requests.post(url, headers=headers, data=payload)
+        response = vault_request("POST", url, headers, data=payload)
         response_json = response.json()
         print("trigger forms Response:", response_json)
 
@@ -277,10 +304,24 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
                     set_event_date(session_id, subj_id, event_group, event_name, date)
                     process_event(session_id, subj_id, event_group, event_name, data_df)
 
+    def repush_event_group(session_id, subj_id, event_group, data_df):
+        # item-level only: the event dates and forms were created by the migration run
+        for event_name in data_df['Event Name'].dropna().unique().tolist():
+            existing_forms = get_forms(session_id, subj_id, event_group, event_name)
+            form_list = []
+            for form_name in data_df.loc[data_df['Event Name'] == event_name, 'Form Name'].dropna().unique().tolist():
+                if form_name in existing_forms:
+                    form_list.append(form_name)
+                else:
+                    failure_lines.append(f"REPUSH SKIPPED - SUBJECT: {subj_id}, EVENT NAME: {event_name}, "
+                                         f"FORM NAME: {form_name}, ERROR: form does not exist in Vault")
+            if form_list:
+                set_form_items(session_id, subj_id, event_group, event_name, data_df, form_list)
+
             
     # --- Main execution for data migration ---
     try:
-        session_id = authenticate()
+        session_id = session_manager.get_session_id()
         
         design_spec = pd.read_excel(TARGET_SPEC_FILE, sheet_name="Schedule - Tree")
         form_def_spec=pd.read_excel(TARGET_SPEC_FILE, sheet_name="Form Definitions") 
@@ -291,18 +332,32 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
         #event_names = design_spec['Event Name'].dropna().unique().tolist()
         
         
-        target_data = pd.read_csv(TRANSFORMED_OUTPUT_FILE)
-        null_values =[ '', ' ', 'NAN', 'nan', None]
-        
         # if old/new subj lists given map them else skip
         if not old_subj_list:
             return {"skipped": True, "message": "No subject mapping provided. Provide subjects mapping in the frontend."}
+        subject_map = OrderedDict()
         for i, new_subj in enumerate(new_subj_list):
             old_subj = old_subj_list[i] if i < len(old_subj_list) else old_subj_list[0]
-            for eg in event_groups:
-                data_df = target_data[(target_data['Event Group Name'] == eg) & (target_data['Subject'] == old_subj) & (target_data['Item Data'].notna()) & (~target_data['Item Data'].isin(null_values))]
-                data_df = data_df.drop_duplicates(subset=['Event Name','Form Name','Item Name','Subject']) if not data_df.empty else data_df
-                process_events_until_stable(session_id, new_subj, eg, data_df)
+            subject_map.setdefault(old_subj, []).append(new_subj)
+
+        if subject_frames is None:
+            subject_frames = iter_subjects_from_csv(TRANSFORMED_OUTPUT_FILE, subjects=list(subject_map))
+
+        for old_subj, subject_data in subject_frames:
+            if old_subj not in subject_map:
+                continue
+            for new_subj in subject_map[old_subj]:
+                for eg in event_groups:
+                    # cheap when cached; refreshes the shared session before it expires on long runs
+                    session_id = session_manager.get_session_id()
+                    data_df = subject_data[(subject_data['Event Group Name'] == eg) & (subject_data['Item Data'].notna()) & (~subject_data['Item Data'].isin(NULL_VALUES))]
+                    data_df = data_df.drop_duplicates(subset=['Event Name','Form Name','Item Name','Subject']) if not data_df.empty else data_df
+                    if repush:
+                        if not data_df.empty:
+                            repush_event_group(session_id, new_subj, eg, data_df)
+                    else:
+                        process_events_until_stable(session_id, new_subj, eg, data_df)
+        run_stats["completed"] = True
                     
     except requests.exceptions.RequestException as e:
         print(f"An API error occurred: {e}")
@@ -317,4 +372,5 @@ def migrate_to_vault(transformed_output_file, STUDY_NAME, SITE_NUMBER, STUDY_COU
             for line in failure_itemgs:
                 f.write(line + "\n")
         print(f"\nData migration process finished. Check '{FAILED_ITEMS_OUTPUT_FILE}' and '{OUTPUT_LOG_FILE}' for any errors.")
+    return run_stats
 
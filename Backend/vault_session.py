@@ -0,0 +1,174 @@
+# Backend/vault_session.py
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from file_lock import file_lock
+
+DEFAULT_CONFIG_FILE = Path(__file__).resolve().parent / "vault_config.json"
+
+# Vault ends a session after a period of inactivity (domain setting, 20 min by default)
+# and never keeps one alive for more than 48 hours.
+IDLE_TIMEOUT = float(os.environ.get("VAULT_SESSION_IDLE_TIMEOUT", 20 * 60))
+MAX_SESSION_AGE = float(os.environ.get("VAULT_SESSION_MAX_AGE", 48 * 3600))
+REFRESH_MARGIN = 60  # refresh this many seconds before the session would expire
+
+
+def load_vault_config(config_file=None):
+    """
+    Read Vault connection settings instead of keeping them in source code.
+    Values come from a JSON file (VAULT_CONFIG_FILE or Backend/vault_config.json,
+    keys VAULT_DNS, API_VERSION, USERNAME, PASSWORD) and are overridden by the
+    VAULT_DNS, VAULT_API_VERSION, VAULT_USERNAME and VAULT_PASSWORD env vars.
+    """
+    config_file = Path(config_file or os.environ.get("VAULT_CONFIG_FILE") or DEFAULT_CONFIG_FILE)
+    vault_config = {"VAULT_DNS": "", "API_VERSION": "v23.2", "USERNAME": "", "PASSWORD": ""}
+    if config_file.exists():
+        with open(config_file, "r", encoding="utf-8") as f:
+            vault_config.update({k: v for k, v in json.load(f).items() if k in vault_config and v})
+    env_keys = {"VAULT_DNS": "VAULT_DNS", "API_VERSION": "VAULT_API_VERSION",
+                "USERNAME": "VAULT_USERNAME", "PASSWORD": "VAULT_PASSWORD"}
+    for key, env_key in env_keys.items():
+        if os.environ.get(env_key):
+            vault_config[key] = os.environ[env_key]
+    return vault_config
+
+
+def is_invalid_session(response_json):
+    """True when Vault rejected the call because the session id is no longer valid."""
+    if not isinstance(response_json, dict) or response_json.get("responseStatus") != "FAILURE":
+        return False
+    return any(err.get("type") == "INVALID_SESSION_ID" for err in response_json.get("errors") or [])
+
+
+class VaultSessionManager:
+    """
+    Hands out a Vault session id shared by every job and worker process that
+    uses the same cache_file. The session is authenticated once, refreshed
+    with the keep-alive endpoint before it goes idle, and re-authenticated only
+    when it is too old or keep-alive fails.
+    """
+
+    def __init__(self, vault_config, cache_file, idle_timeout=IDLE_TIMEOUT, max_age=MAX_SESSION_AGE):
+        self.vault_dns = vault_config["VAULT_DNS"]
+        self.api_version = vault_config.get("API_VERSION", "v23.2")
+        self.username = vault_config["USERNAME"]
+        self.password = vault_config["PASSWORD"]
+        self.cache_file = Path(cache_file)
+        self.lock_file = self.cache_file.with_suffix(".lock")
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.key = f"{self.vault_dns}|{self.username}"
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "auth_count": 0,
+            "auth_latency_last_ms": None,
+            "auth_latency_total_ms": 0.0,
+            "refresh_count": 0,
+            "refresh_failures": 0,
+            "refresh_latency_last_ms": None,
+            "reuse_count": 0,
+        }
+
+    def _url(self, path):
+        return f"https://{self.vault_dns}/api/{self.api_version}/{path}"
+
+    def _read_cache(self):
+        if not self.cache_file.exists():
+            return {}
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_cache(self, cache):
+        tmp_path = self.cache_file.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.chmod(tmp_path, 0o600)  # session ids are credentials
+        os.replace(tmp_path, self.cache_file)
+
+    def _authenticate(self):
+        start = time.perf_counter()
+        response = requests.post(self._url("auth"), data={"username": self.username, "password": self.password})
+        response.raise_for_status()
+        response_json = response.json()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._stats["auth_count"] += 1
+        self._stats["auth_latency_last_ms"] = round(elapsed_ms, 1)
+        self._stats["auth_latency_total_ms"] += elapsed_ms
+        if response_json.get("responseStatus") != "SUCCESS" or not response_json.get("sessionId"):
+            raise requests.exceptions.RequestException(f"Vault authentication failed: {response_json.get('errors')}")
+        print("Authentication successful.")
+        return response_json["sessionId"]
+
+    def _keep_alive(self, session_id):
+        start = time.perf_counter()
+        try:
+            response = requests.post(self._url("keep-alive"),
+                                     headers={"Accept": "application/json", "Authorization": session_id})
+            ok = response.ok and response.json().get("responseStatus") == "SUCCESS"
+        except (requests.exceptions.RequestException, ValueError):
+            ok = False
+        self._stats["refresh_latency_last_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        self._stats["refresh_count" if ok else "refresh_failures"] += 1
+        return ok
+
+    def get_session_id(self):
+        """Return a valid session id, reusing, refreshing or creating it as needed."""
+        with self._lock, file_lock(self.lock_file):
+            cache = self._read_cache()
+            entry = cache.get(self.key)
+            now = time.time()
+
+            if entry and now - entry["created"] < self.max_age - REFRESH_MARGIN:
+                if now - entry["last_activity"] < self.idle_timeout - REFRESH_MARGIN:
+                    self._stats["reuse_count"] += 1
+                elif not self._keep_alive(entry["session_id"]):
+                    entry = None
+            else:
+                entry = None
+
+            if entry is None:
+                entry = {"session_id": self._authenticate(), "created": time.time()}
+            entry["last_activity"] = time.time()
+            cache[self.key] = entry
+            self._write_cache(cache)
+            return entry["session_id"]
+
+    def invalidate(self, session_id):
+        """Drop a session Vault rejected so the next get_session_id authenticates again."""
+        with self._lock, file_lock(self.lock_file):
+            cache = self._read_cache()
+            entry = cache.get(self.key)
+            if entry and entry["session_id"] == session_id:
+                del cache[self.key]
+                self._write_cache(cache)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        total_ms = stats.pop("auth_latency_total_ms")
+        stats["auth_latency_avg_ms"] = round(total_ms / stats["auth_count"], 1) if stats["auth_count"] else None
+        return stats
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_session_manager(vault_config, cache_file):
+    """One manager per Vault user and cache file, shared by every job of this process."""
+    key = (vault_config["VAULT_DNS"], vault_config["USERNAME"], str(Path(cache_file).resolve()))
+    with _managers_lock:
+        if key not in _managers:
+            _managers[key] = VaultSessionManager(vault_config, cache_file)
+        manager = _managers[key]
+        manager.password = vault_config["PASSWORD"]
+        return manager
@@ -17,6 +17,7 @@ const InputPanel = ({ setSnackbar }) => {
     siteCountry: "",
     subjects: "",
     targetSpec: null,
+    formsBundle: [],
   });
 
   const [results, setResults] = useState(null);
@@ -29,6 +30,10 @@ const InputPanel = ({ setSnackbar }) => {
     setForm({ ...form, targetSpec: file });
   };
 
+  const handleBundle = (files) => {
+    setForm({ ...form, formsBundle: Array.from(files || []) });
+  };
+
   const handleSubmit = async (e) => {
     e.preventDefault();
     if (!form.targetSpec) {
@@ -47,6 +52,7 @@ const InputPanel = ({ setSnackbar }) => {
       fd.append("siteCountry", form.siteCountry);
       fd.append("subjects", form.subjects);
       fd.append("targetSpec", form.targetSpec);
+      form.formsBundle.forEach((file) => fd.append("formsBundle", file));
 
       setSnackbar({ open: true, message: "Processing...", severity: "info" });
 
@@ -137,6 +143,18 @@ console.log("Results:", results);
               />
             </Grid>
 
+            <Grid item xs={12}>
+              <Typography>
+                Upload Form Exports (optional, zip or csv; defaults to data/forms)
+              </Typography>
+              <input
+                type="file"
+                accept=".zip, .csv"
+                multiple
+                onChange={(e) => handleBundle(e.target.files)}
+              />
+            </Grid>
+
             <Grid item xs={12}>
               <Box textAlign="center">
                 <Button variant="contained" color="primary" type="submit">